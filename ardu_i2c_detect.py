@@ -3,17 +3,29 @@ import subprocess
 import sys
 import re
 import time
-import glob
 import os
 import argparse
-import json
+import functools
+from collections import defaultdict
+
+import msgspec
+
+from mapping_table import MappingEntry
 
 # Optional YAML support
 try:
     import yaml
     YAML_AVAILABLE = True
+    # Prefer the LibYAML C bindings, fall back to the pure-Python ones
+    try:
+        from yaml import CSafeDumper as SafeDumper
+        YAML_LIBYAML = True
+    except ImportError:
+        from yaml import SafeDumper
+        YAML_LIBYAML = False
 except ImportError:
     YAML_AVAILABLE = False
+    YAML_LIBYAML = False
 
 # Known sensor names
 SENSOR_NAMES = [
@@ -21,19 +33,51 @@ SENSOR_NAMES = [
     # Add other sensors here
 ]
 
+# Capture receivers exposing a single sensor per device, whose
+# /dev/videoX nodes can share one probe
+SINGLE_SENSOR_DRIVERS = (
+    "unicam",
+    "rp1-cfe",
+)
+
 # GStreamer settings
 NUM_BUFFERS = 20
 DELAY_AFTER_TRIGGER = 0.5  # seconds
 DEFAULT_TABLE_PATH = "/opt/arducam/arducam_i2c_map.json"
 
+# Kernel log settings
+KMSG_PATH = "/dev/kmsg"
+KMSG_RECORD_MAX = 8192  # bytes, larger than any single kernel log record
+
 
-def clear_dmesg():
-    """Clear kernel log buffer"""
+def open_kmsg():
+    """Open kernel log positioned after the existing records"""
     try:
-        subprocess.run(["dmesg", "-C"], check=True)
-        print("[+] Cleared dmesg buffer")
+        kmsg = open(KMSG_PATH, "rb", buffering=0)
     except Exception as e:
-        print("[-] Failed to clear dmesg:", e)
+        print(f"[-] Failed to open {KMSG_PATH}:", e)
+        return None
+    os.lseek(kmsg.fileno(), 0, os.SEEK_END)
+    os.set_blocking(kmsg.fileno(), False)
+    return kmsg
+
+
+def read_kmsg(kmsg):
+    """Read kernel log records appended since open_kmsg()"""
+    messages = []
+    while True:
+        try:
+            record = os.read(kmsg.fileno(), KMSG_RECORD_MAX)
+        except BlockingIOError:
+            break
+        except BrokenPipeError:
+            # Ring buffer wrapped past our position, continue with next record
+            continue
+        if not record:
+            break
+        # Record format: "prio,seq,ts,flags;message\n"
+        messages.append(record.partition(b";")[2])
+    return b"".join(messages)
 
 
 def trigger_sensor(video_dev):
@@ -52,63 +96,88 @@ def trigger_sensor(video_dev):
         return False
 
 
-def parse_i2c_bus_from_dmesg(sensor_name):
-    """Parse dmesg to detect I2C bus number"""
-    try:
-        dmesg_output = subprocess.check_output(["dmesg"], text=True)
-    except Exception as e:
-        print("[-] Failed to read dmesg:", e)
-        return []
+@functools.lru_cache(maxsize=None)
+def sensor_pattern(sensor_names):
+    """Compiled kernel log pattern matching any of the given sensor names"""
+    # Anchored at the start of a record message, as emitted by dev_printk()
+    return re.compile(
+        rb"^(" + b"|".join(re.escape(s.encode()) for s in sensor_names) + rb")\s+(\d+)-[0-9a-fA-F]+:", re.MULTILINE)
+
 
-    buses = set()
-    pattern = re.compile(rf"{re.escape(sensor_name)}\s+(\d+)-[0-9a-fA-F]+:")
-    for line in dmesg_output.splitlines():
-        if sensor_name in line:
-            m = pattern.search(line)
-            if m:
-                buses.add(f"i2c-{m.group(1)}")
-    return list(buses)
+def parse_i2c_buses(log_output, sensor_names):
+    """Parse kernel log output to detect I2C bus numbers for all sensors"""
+    buses = defaultdict(set)
+    for m in sensor_pattern(tuple(sensor_names)).finditer(log_output):
+        buses[m.group(1).decode()].add(f"i2c-{m.group(2).decode()}")
+    return {sensor: list(found) for sensor, found in buses.items()}
+
+
+def capture_kmsg(video_dev):
+    """Trigger a /dev/videoX and return the kernel log it produced"""
+    # Triggers must not overlap: /dev/kmsg is a single stream and sensor
+    # messages carry no hint of which /dev/videoX caused them
+    kmsg = open_kmsg()
+    if kmsg is None:
+        return None
+    with kmsg:
+        if not trigger_sensor(video_dev):
+            return None
+        return read_kmsg(kmsg)
 
 
 def detect_i2c_for_device(video_dev, sensor_names):
     """Detect I2C bus(es) for a given /dev/videoX"""
-    clear_dmesg()
-    success = trigger_sensor(video_dev)
-    if not success:
+    log_output = capture_kmsg(video_dev)
+    if log_output is None:
         # Skip parsing if pipeline failed
         return {sensor: None for sensor in sensor_names}
 
-    detected = {}
-    for sensor in sensor_names:
-        buses = parse_i2c_bus_from_dmesg(sensor)
-        if buses:
-            detected[sensor] = buses
+    buses = parse_i2c_buses(log_output, sensor_names)
+    return {sensor: buses.get(sensor) for sensor in sensor_names}
+
+
+def group_video_devices(video_devs):
+    """Group /dev/videoX nodes backed by the same single-sensor receiver"""
+    groups = {}
+    for video_dev in video_devs:
+        device = f"/sys/class/video4linux/{os.path.basename(video_dev)}/device"
+        driver = os.path.basename(os.path.realpath(f"{device}/driver"))
+        # Receivers serving several sensors (e.g. tegra-capture-vi) and nodes
+        # without a sysfs device link are probed on their own
+        if os.path.islink(device) and driver in SINGLE_SENSOR_DRIVERS:
+            key = os.path.realpath(device)
         else:
-            detected[sensor] = None
-    return detected
+            key = video_dev
+        groups.setdefault(key, []).append(video_dev)
+    return list(groups.values())
 
 
 def scan_all_devices(sensor_names):
     """Scan all /dev/video* devices and build mapping"""
-    video_devs = sorted(glob.glob("/dev/video*"))
-    mapping = {}
-    for video_dev in video_devs:
-        if "subdev" in video_dev:
-            continue
-        detected = detect_i2c_for_device(video_dev, sensor_names)
+    video_devs = sorted(
+        (e.path for e in os.scandir("/dev") if e.name.startswith("video") and e.name[5:].isdigit()),
+        key=lambda path: int(os.path.basename(path)[5:]))
 
+    # Nodes of one group share the sensor, so stop at the first detection
+    mapping = {}
+    for group in group_video_devices(video_devs):
         entry = None
-        for sensor, buses in detected.items():
-            if buses:
-                bus_name = buses[0]
-                bus_num = int(bus_name.split("-")[1])
-                entry = {"bus": bus_num, "addr": f"0x0c", "sensor": sensor}
+        for video_dev in group:
+            detected = detect_i2c_for_device(video_dev, sensor_names)
+            for sensor, buses in detected.items():
+                if buses:
+                    bus_num = int(buses[0].split("-")[1])
+                    entry = MappingEntry(bus=bus_num, sensor=sensor)
+                    break
+            if entry:
                 break
-        mapping[os.path.basename(video_dev)] = entry
-    return mapping
+        for video_dev in group:
+            mapping[os.path.basename(video_dev)] = entry
+
+    return {os.path.basename(dev): mapping[os.path.basename(dev)] for dev in video_devs}
 
 
-def save_mapping_table(mapping, path=None):
+def save_mapping_table(mapping, path=None, pretty=False):
     if path is None:
         path = DEFAULT_TABLE_PATH
 
@@ -122,11 +191,28 @@ def save_mapping_table(mapping, path=None):
         if not YAML_AVAILABLE:
             print("[-] PyYAML not installed, cannot save YAML")
             return
-        with open(path, "w") as f:
-            yaml.dump(mapping, f, default_flow_style=False)
+        if not YAML_LIBYAML:
+            print("[-] LibYAML not available, using slow pure-Python YAML "
+                  "(apt install libyaml-dev && pip install --force-reinstall pyyaml)")
+        data = yaml.dump(msgspec.to_builtins(mapping), Dumper=SafeDumper,
+                         default_flow_style=False).encode()
     else:
-        with open(path, "w") as f:
-            json.dump(mapping, f, indent=4)
+        data = msgspec.json.encode(mapping)
+        if pretty:
+            data = msgspec.json.format(data, indent=4)
+
+    # Write next to the destination and rename, so readers never see a partial table
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
     print(f"[+] Saved mapping table to {path}")
 
 
@@ -135,6 +221,8 @@ def main():
     parser.add_argument("video_dev", nargs="?", help="Optional /dev/videoX device to scan")
     parser.add_argument("-t", "--table", nargs="?", const=True,
                         help="Save mapping table (optionally specify path/filename)")
+    parser.add_argument("-p", "--pretty", action="store_true",
+                        help="Indent the saved JSON mapping table")
     args = parser.parse_args()
 
     if args.video_dev:
@@ -151,12 +239,12 @@ def main():
         mapping = scan_all_devices(SENSOR_NAMES)
         for video, val in mapping.items():
             if val:
-                print(f"[+] {video} → bus {val['bus']}, addr {val['addr']}, sensor {val['sensor']}")
+                print(f"[+] {video} → bus {val.bus}, addr 0x{val.addr:02x}, sensor {val.sensor}")
             else:
                 print(f"[-] {video} → no sensor detected")
         if args.table:
             path = args.table if isinstance(args.table, str) else None
-            save_mapping_table(mapping, path)
+            save_mapping_table(mapping, path, pretty=args.pretty)
 
 
 if __name__ == "__main__":
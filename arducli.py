@@ -2,16 +2,21 @@
 
 import sys
 import os
-import json
+import atexit
+import functools
 import subprocess
 import glob
 import time
 import argparse
-from enum import Enum
+from types import MappingProxyType
+from typing import Optional
+
+import msgspec
 
 # Ensure local i2c_tools.py can be imported
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from i2c_tools import I2CDevice
+from mapping_table import MappingEntry
 
 # Version
 VERSION_MJR = 1
@@ -52,7 +57,7 @@ CTRL_VALUE_REG = (CTRL_REG_BASE | 0x0006)
 NO_DATA_AVAILABLE = 0xFFFFFFFE
 
 # Pixel format mapping
-pix_type_map = {
+pix_type_map = MappingProxyType({
     0x2A: "RAW8",
     0x2B: "RAW10",
     0x2C: "RAW12",
@@ -60,22 +65,12 @@ pix_type_map = {
     0x19: "YUV420_10BIT",
     0x1E: "YUV422_8BIT",
     0x30: "JPEG",
-}
+})
 
-raw_bayer_order = {
-    0x0: "BGGR",
-    0x1: "GBRG",
-    0x2: "GRBG",
-    0x3: "RGGB",
-    0x4: "MONO",
-}
+# Indexed by the PIXFORMAT_ORDER_REG value
+raw_bayer_order = ("BGGR", "GBRG", "GRBG", "RGGB", "MONO")
 
-yuv_order = {
-    0x0: "YUYV",
-    0x1: "YVYU",
-    0x2: "UYVY",
-    0x3: "VYUY",
-}
+yuv_order = ("YUYV", "YVYU", "UYVY", "VYUY")
 
 control_id_map = {
     0x980902: "Saturation",
@@ -96,7 +91,7 @@ control_id_map = {
     0x980913: "gain",
 }
 
-ID_map = {
+ID_map = MappingProxyType({
     0x980914: "horizontal_flip",
     0x980915: "vertical_flip",
     0x98190E: "strobe_width",
@@ -105,38 +100,73 @@ ID_map = {
     0x9e0902: "horizontal_blanking",
     0x9f0902: "pixel_rate",
     0x98091C: "backlight_compensation",
-}
-
-ID_map.update(control_id_map)
-
-class Level(Enum):
-    WARNING = 2
-    ERROR = 1
-    INFO = 0
+    **control_id_map,
+})
+
+# Log levels, used as index into LOG_PREFIX
+INFO = 0
+ERROR = 1
+WARNING = 2
+LOG_PREFIX = ("[INFO]", "[ERROR]", "[WARNING]")
+
+# One I2CDevice per bus, shared by all cameras probed on it
+@functools.lru_cache(maxsize=None)
+def _get_i2c(bus):
+    i2c = I2CDevice(bus)
+    atexit.register(i2c.close)
+    return i2c
 
 class PivarietyCamera:
-    def __init__(self, bus):
+    def __init__(self, bus, i2c_address=0x0C):
         self.bus = bus
-        self.i2c_address = 0x0C
+        self.i2c_address = i2c_address
         try:
-            self.i2c = I2CDevice(self.bus)
+            self.i2c = _get_i2c(self.bus)
         except Exception as e:
             raise RuntimeError(f"Failed to open I2C bus {bus}: {e}")
 
     def readReg(self, register):
         return self.i2c.read_16_32(self.i2c_address, register)
 
+    def readRegs(self, registers):
+        return self.i2c.read_16_32_burst(self.i2c_address, registers)
+
     def writeReg(self, register, value):
         self.i2c.write_16_32(self.i2c_address, register, value)
 
-def wait_for_free():
-    time.sleep(0.05)
+def wait_for_free(camera, timeout=0.05):
+    # Poll the idle flag (0 = idle) instead of always waiting the full timeout
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if camera.readReg(SYSTEM_IDLE_REG) == 0:
+            return
+        time.sleep(0.0005)
+
+def format_log(text, level=INFO):
+    return f"{LOG_PREFIX[level]}: {text}"
 
-def logging(text, level=Level.INFO):
-    prefix = "[INFO]" if level == Level.INFO else "[WARNING]" if level == Level.WARNING else "[ERROR]"
-    print(f"{prefix}: {text}")
+def logging(text, level=INFO):
+    print(format_log(text, level))
+
+def write_lines(lines):
+    # One write for a whole report instead of one per print()
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
 
 def enum_resolutions(camera):
+    # Locate the Framerate control once, its max is read per resolution
+    fps_ctrl_index = None
+    ctrl_index = 0
+    while True:
+        camera.writeReg(CTRL_INDEX_REG, ctrl_index)
+        ctrl_id = camera.readReg(CTRL_ID_REG)
+        if ctrl_id == NO_DATA_AVAILABLE:
+            break
+        if ctrl_id == 0x981906:  # Framerate
+            fps_ctrl_index = ctrl_index
+            break
+        ctrl_index += 1
+
     index = 0
     resolutions = []
     while True:
@@ -144,27 +174,62 @@ def enum_resolutions(camera):
         val = camera.readReg(RESOLUTION_INDEX_REG)
         if val == NO_DATA_AVAILABLE:
             break
-        width = camera.readReg(FORMAT_WIDTH_REG)
-        height = camera.readReg(FORMAT_HEIGHT_REG)
+        width, height = camera.readRegs([FORMAT_WIDTH_REG, FORMAT_HEIGHT_REG])
 
-        # Get max framerate from Framerate control
-        camera.writeReg(CTRL_INDEX_REG, 0)
+        # Max framerate depends on the selected resolution
         max_fps = None
-        ctrl_index = 0
-        while True:
-            camera.writeReg(CTRL_INDEX_REG, ctrl_index)
-            ctrl_id = camera.readReg(CTRL_ID_REG)
-            if ctrl_id == NO_DATA_AVAILABLE:
-                break
-            if ctrl_id == 0x981906:  # Framerate
-                max_fps = camera.readReg(CTRL_MAX_REG)
-                break
-            ctrl_index += 1
+        if fps_ctrl_index is not None:
+            camera.writeReg(CTRL_INDEX_REG, fps_ctrl_index)
+            max_fps = camera.readReg(CTRL_MAX_REG)
 
         resolutions.append({"index": index, "width": width, "height": height, "max_fps": max_fps})
         index += 1
     return resolutions
 
+def enum_pixformats(camera):
+    index = 0
+    pix_formats = []
+    while True:
+        camera.writeReg(PIXFORMAT_INDEX_REG, index)
+        val = camera.readReg(PIXFORMAT_INDEX_REG)
+        if val == NO_DATA_AVAILABLE:
+            break
+
+        pix_type = camera.readReg(PIXFORMAT_TYPE_REG)
+        pix_order = camera.readReg(PIXFORMAT_ORDER_REG)
+        lanes = camera.readReg(MIPI_LANES_REG)
+
+        order = None
+        if pix_type in [0x2A, 0x2B, 0x2C]:
+            order = raw_bayer_order[pix_order] if pix_order < len(raw_bayer_order) else "Unknown"
+        elif pix_type in [0x18, 0x19, 0x1E]:
+            order = yuv_order[pix_order] if pix_order < len(yuv_order) else "Unknown"
+
+        # Resolutions and controls are enumerated for the selected pixel format
+        resolutions = enum_resolutions(camera)
+        controls = enum_controls(camera)
+
+        pix_formats.append({"index": index, "type": pix_type_map.get(pix_type, "Unknown"), "order": order, "lanes": lanes,
+                            "resolutions": resolutions, "controls": controls})
+        index += 1
+    return pix_formats
+
+def enum_controls(camera):
+    index = 0
+    controls = []
+    while True:
+        camera.writeReg(CTRL_INDEX_REG, index)
+        ctrl_id = camera.readReg(CTRL_ID_REG)
+        if ctrl_id == NO_DATA_AVAILABLE:
+            break
+
+        camera.writeReg(CTRL_VALUE_REG, 0)
+        wait_for_free(camera)
+        max_val, min_val, def_val = camera.readRegs([CTRL_MAX_REG, CTRL_MIN_REG, CTRL_DEF_REG])
+        controls.append({"id": ctrl_id, "min": min_val, "max": max_val, "def": def_val})
+        index += 1
+    return controls
+
 # -------------------------------
 # FIXED V4L2 OUTPUT (v1.5 update)
 # -------------------------------
@@ -179,9 +244,9 @@ def list_formats(camera, extended=False):
 
     # Determine FOURCC
     if pix_type in [0x18, 0x19, 0x1E]:
-        fourcc = yuv_order.get(pix_order, "YUYV")
+        fourcc = yuv_order[pix_order] if pix_order < len(yuv_order) else "YUYV"
     elif pix_type in [0x2A, 0x2B, 0x2C]:
-        fourcc = raw_bayer_order.get(pix_order, "RGGB")
+        fourcc = raw_bayer_order[pix_order] if pix_order < len(raw_bayer_order) else "RGGB"
     elif pix_type == 0x30:
         fourcc = "MJPG"
     else:
@@ -189,8 +254,7 @@ def list_formats(camera, extended=False):
 
     resolutions = enum_resolutions(camera)
 
-    print("ioctl: VIDIOC_ENUM_FMT")
-    print("        Type: Video Capture\n")
+    out = ["ioctl: VIDIOC_ENUM_FMT", "        Type: Video Capture\n"]
 
     for res in resolutions:
         idx = res["index"]
@@ -198,38 +262,34 @@ def list_formats(camera, extended=False):
         height = res["height"]
         fps = res["max_fps"]
 
-        print(f"        [{idx}]: '{fourcc}' ({pix_name})")
+        out.append(f"        [{idx}]: '{fourcc}' ({pix_name})")
 
         if extended:
-            print(f"                Size: Discrete {width}x{height}")
+            out.append(f"                Size: Discrete {width}x{height}")
             if fps:
                 interval = 1.0 / fps
-                print(f"                        Interval: Discrete {interval:.3f}s ({fps:.3f} fps)")
+                out.append(f"                        Interval: Discrete {interval:.3f}s ({fps:.3f} fps)")
+
+    write_lines(out)
 
 def get_software_fw_version(camera):
     version_length = camera.readReg(SOFT_VERSION_LEN_REG) 
     if version_length == NO_DATA_AVAILABLE or version_length > 255:
         return "None"
     
-    version = ""
+    version = bytearray()
     for i in range(version_length):
         camera.writeReg(SOFT_VERSION_INDEX_REG, i)
         ch = camera.readReg(SOFT_VERSION_REG)
         if ch > 255:
             continue
-        version += chr(ch)
-    return version
+        version.append(ch)
+    return version.decode("latin-1")
 
 def parse_isp_fw_version(isp_fw_version):
-    isp_id = (isp_fw_version & 0xFFFF0000) >> 16
-    isp_id_high = (isp_id & 0xFF00) >> 8
-    isp_id_low = (isp_id & 0x00FF)
-    isp_fw_date = (isp_fw_version & 0xFFFF) 
-    isp_fw_year = isp_fw_date >> 9
-    isp_fw_month = (isp_fw_date >> 5) & 0x0F
-    isp_fw_day = isp_fw_date & 0x1F
-
-    return f"v{isp_id_high:x}.{isp_id_low:02x} 20{isp_fw_year:02d}/{isp_fw_month:02d}/{isp_fw_day:02d}"
+    # [31:24] id high, [23:16] id low, [15:0] date as yyyyyyym mmmddddd
+    id_high, id_low, date = (isp_fw_version >> 24) & 0xFF, (isp_fw_version >> 16) & 0xFF, isp_fw_version & 0xFFFF
+    return f"v{id_high:x}.{id_low:02x} 20{date >> 9:02d}/{(date >> 5) & 0x0F:02d}/{date & 0x1F:02d}"
 
 def main():
     parser = argparse.ArgumentParser(description="Arducam CLI")
@@ -241,7 +301,7 @@ def main():
     args = parser.parse_args()
 
     if args.bus is not None and args.device is not None:
-        logging("Options -b and -d are mutually exclusive", Level.ERROR)
+        logging("Options -b and -d are mutually exclusive", ERROR)
         sys.exit(1)
 
     if args.verbose:
@@ -254,101 +314,75 @@ def main():
     # Load mapping table
     if os.path.exists(DEFAULT_MAPPING_PATH):
         logging(f"Loading mapping table from {DEFAULT_MAPPING_PATH}")
-        with open(DEFAULT_MAPPING_PATH) as f:
-            mapping = json.load(f)
+        with open(DEFAULT_MAPPING_PATH, "rb") as f:
+            try:
+                mapping = msgspec.json.decode(f.read(), type=dict[str, Optional[MappingEntry]])
+            except msgspec.DecodeError as e:
+                logging(f"Invalid mapping table ({e}), please re-run ardu_i2c_detect.py.", ERROR)
+                sys.exit(1)
     else:
-        logging("Mapping table not found, please run ardu_i2c_detect.py first.", Level.ERROR)
+        logging("Mapping table not found, please run ardu_i2c_detect.py first.", ERROR)
         sys.exit(1)
 
     # Determine devices to probe
     devices_to_probe = []
     if args.bus is not None:
-        devices_to_probe.append({"bus": args.bus, "name": "manual"})
+        devices_to_probe.append({"bus": args.bus, "addr": 0x0C, "name": "manual"})
     elif args.device is not None:
         dev_name = os.path.basename(args.device)
         if dev_name not in mapping or not mapping[dev_name]:
-            logging(f"No mapping found for device {args.device}", Level.ERROR)
+            logging(f"No mapping found for device {args.device}", ERROR)
             sys.exit(1)
-        devices_to_probe.append({"bus": mapping[dev_name]["bus"], "name": dev_name})
+        info = mapping[dev_name]
+        devices_to_probe.append({"bus": info.bus, "addr": info.addr, "name": dev_name})
     else:
         for dev_name, info in mapping.items():
             if info:
-                devices_to_probe.append({"bus": info["bus"], "name": dev_name})
+                devices_to_probe.append({"bus": info.bus, "addr": info.addr, "name": dev_name})
 
     # Probe devices
     for dev in devices_to_probe:
         try:
-            camera = PivarietyCamera(dev["bus"])
+            camera = PivarietyCamera(dev["bus"], dev["addr"])
         except RuntimeError as e:
-            logging(str(e), Level.ERROR)
+            logging(str(e), ERROR)
             continue
 
         if args.list_formats or args.list_formats_ext:
             list_formats(camera, extended=args.list_formats_ext)
             continue
 
-        # Full info probe
-        device_id = camera.readReg(DEVICE_ID_REG)
-        device_version = camera.readReg(DEVICE_VERSION_REG)
-        sensor_id = camera.readReg(FIRMWARE_SENSOR_ID_REG)
-        isp_fw_version = camera.readReg(UNIQUE_ID_REG)
-
-        logging(f"Device ID: 0x{device_id:02X}")
-        logging(f"Device Version: 0x{device_version:02X}")
-        logging(f"Sensor ID: 0x{sensor_id:04X}")
-        logging(f"ISP FW Version: {parse_isp_fw_version(isp_fw_version)}")
-        logging(f"Software FW Version: {get_software_fw_version(camera)}")
-
-        pix_index = 0
-        while True:
-            camera.writeReg(PIXFORMAT_INDEX_REG, pix_index)
-            val = camera.readReg(PIXFORMAT_INDEX_REG)
-            if val == NO_DATA_AVAILABLE:
-                break
-
-            pix_type = camera.readReg(PIXFORMAT_TYPE_REG)
-            bayer_order = camera.readReg(PIXFORMAT_ORDER_REG)
-            lanes = camera.readReg(MIPI_LANES_REG)
-
-            dtype = pix_type_map.get(pix_type, "Unknown")
-            order = None
-
-            if pix_type in [0x2A, 0x2B, 0x2C]:
-                order = raw_bayer_order.get(bayer_order, "Unknown")
-            elif pix_type in [0x18, 0x19, 0x1E]:
-                order = yuv_order.get(bayer_order, "Unknown")
-
-            if order:
-                logging(f"PixelFormat Type: {dtype}, Order: {order}, Lanes: {lanes}")
-            else:
-                logging(f"PixelFormat Type: {dtype}, Lanes: {lanes}")
-
-            # Resolutions
-            resolutions = enum_resolutions(camera)
-            for res in resolutions:
-                idx = res["index"]
-                width = res["width"]
-                height = res["height"]
-                maxfps = res["max_fps"]
-                logging(f"index: {idx}, {width}x{height}")
-
-                # Controls
-                ctrl_index = 0
-                while True:
-                    camera.writeReg(CTRL_INDEX_REG, ctrl_index)
-                    ctrl_id = camera.readReg(CTRL_ID_REG)
-                    if ctrl_id == NO_DATA_AVAILABLE:
-                        break
-
-                    camera.writeReg(CTRL_VALUE_REG, 0)
-                    wait_for_free()
-                    max_val = camera.readReg(CTRL_MAX_REG)
-                    min_val = camera.readReg(CTRL_MIN_REG)
-                    def_val = camera.readReg(CTRL_DEF_REG)
-                    logging(f"ID: 0x{ctrl_id:06X}, control_name: {ID_map.get(ctrl_id, 'Unknown')} MAX: {max_val}, MIN: {min_val}, DEF: {def_val}")
-                    ctrl_index += 1
-
-            pix_index += 1
+        # Full info probe, lines gathered so far are printed even if a read fails
+        out = []
+        try:
+            out.append(format_log(f"Device ID: 0x{camera.readReg(DEVICE_ID_REG):02X}"))
+            out.append(format_log(f"Device Version: 0x{camera.readReg(DEVICE_VERSION_REG):02X}"))
+            out.append(format_log(f"Sensor ID: 0x{camera.readReg(FIRMWARE_SENSOR_ID_REG):04X}"))
+            out.append(format_log(f"ISP FW Version: {parse_isp_fw_version(camera.readReg(UNIQUE_ID_REG))}"))
+            out.append(format_log(f"Software FW Version: {get_software_fw_version(camera)}"))
+
+            # Header goes out before the slow pixel format/resolution/control passes
+            write_lines(out)
+            out = []
+
+            # Read everything once, then print from the cached lists
+            pix_formats = enum_pixformats(camera)
+
+            for pix in pix_formats:
+                if pix["order"]:
+                    out.append(format_log(f"PixelFormat Type: {pix['type']}, Order: {pix['order']}, Lanes: {pix['lanes']}"))
+                else:
+                    out.append(format_log(f"PixelFormat Type: {pix['type']}, Lanes: {pix['lanes']}"))
+
+                for res in pix["resolutions"]:
+                    out.append(format_log(f"index: {res['index']}, {res['width']}x{res['height']}"))
+
+                    for ctrl in pix["controls"]:
+                        ctrl_id = ctrl["id"]
+                        out.append(format_log(f"ID: 0x{ctrl_id:06X}, control_name: {ID_map.get(ctrl_id, 'Unknown')} MAX: {ctrl['max']}, MIN: {ctrl['min']}, DEF: {ctrl['def']}"))
+        finally:
+            if out:
+                write_lines(out)
 
         camera.writeReg(PIXFORMAT_INDEX_REG, 0)
 
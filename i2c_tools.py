@@ -5,6 +5,7 @@ class I2CDevice(object):
     def __init__(self, bus_num) -> None:
         self.bus_num = bus_num
         self.bus = SMBus(self.bus_num)
+        self.burst_supported = True
     
     def write_16_8(self, chip_address, register, value):
         msg = i2c_msg.write(chip_address, [(register & 0xFF00) >> 8, register & 0xFF, value & 0xFF])
@@ -48,6 +49,24 @@ class I2CDevice(object):
         self.bus.i2c_rdwr(msg_write, msg_read)
         # print(msg_read.len)
         return int.from_bytes(msg_read.buf[:4], "big")
+
+    def read_16_32_burst(self, chip_address, registers):
+        if not self.burst_supported:
+            return [self.read_16_32(chip_address, register) for register in registers]
+
+        msgs = []
+        for register in registers:
+            msgs.append(i2c_msg.write(chip_address & 0xFF, [(register & 0xFF00) >> 8, register & 0xFF]))
+            msgs.append(i2c_msg.read(chip_address & 0xFF, 4))
+
+        # Single I2C_RDWR ioctl for all registers. Some adapters (e.g. i2c-bcm2835)
+        # only accept one read message, as the last one, or cap the message count.
+        try:
+            self.bus.i2c_rdwr(*msgs)
+        except OSError:
+            self.burst_supported = False
+            return [self.read_16_32(chip_address, register) for register in registers]
+        return [int.from_bytes(msg_read.buf[:4], "big") for msg_read in msgs[1::2]]
     
     def read_16_X(self, chip_address, register, len):
         msg_write = i2c_msg.write(chip_address & 0xFF, [(register & 0xFF00) >> 8, register & 0xFF])
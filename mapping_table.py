@@ -0,0 +1,15 @@
+from typing import Union
+
+import msgspec
+
+
+class MappingEntry(msgspec.Struct, kw_only=True):
+    """Mapping table entry for a /dev/videoX"""
+    bus: int
+    # Tables written before v1.5 store the address as a "0x0c" string
+    addr: Union[int, str] = 0x0C
+    sensor: str
+
+    def __post_init__(self):
+        if isinstance(self.addr, str):
+            self.addr = int(self.addr, 16)